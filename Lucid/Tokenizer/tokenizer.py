@@ -1,6 +1,22 @@
-from collections import Counter, deque
+from array import array
+from collections import Counter, defaultdict
+from collections.abc import Iterable, Sequence
+from functools import lru_cache
+import heapq
+from itertools import accumulate, islice
 import json
+from operator import itemgetter
 import re
+import struct
+import sys
+
+# Header of the binary vocab and merges file : magic, format version, vocab size, number of merges
+_BINARY_MAGIC = b"LBPE"
+_BINARY_VERSION = 1
+_BINARY_HEADER = struct.Struct("<4sIII")
+
+# Deepest trie of special tokens turned into nested groups, `re` recurses once per group
+_MAX_PATTERN_NESTING = 100
 
 class BPETokenizer:
 
@@ -11,6 +27,15 @@ class BPETokenizer:
         self.inverse_vocab = {}
         # Dictionary of BPE merges : {(token_id1, token_id2): merged_token_id}
         self.bpe_merges = {}
+        # Special tokens ("<|...|>") in the vocab, rebuilt whenever the vocab changes
+        self._special_tokens = []
+        # Maps token id to its decoded text as UTF-8, with "Ġ" rendered as a space
+        self._decoded_bytes = {}
+        # BPE merges nested by token : {token_id1: {token_id2: merged_token_id}}
+        self._merge_table = {}
+        # The vocab and merges dicts, and their sizes, the lookup tables were built from
+        self._lookup_tables_source = (None, None, None)
+        self._lookup_tables_sizes = (0, 0, 0)
 
 
     def train(self, text: str, vocab_size: int, allowed_special: set[str] = {"<|endoftext|>"}) -> None:
@@ -23,19 +48,15 @@ class BPETokenizer:
             allowed_special (set) : A set of included special tokens
         """
 
-        # Replace space with "Ġ"
-        processed_text = []
-        for i, char in enumerate(text):
-            if char == " " and i != 0:
-                processed_text.append("Ġ")
-            if char != " ":
-                processed_text.append(char)
-        processed_text = "".join(processed_text)
+        # Replace space with "Ġ", dropping a space at the very start of the text
+        processed_text = text[:1].replace(" ", "") + text[1:].replace(" ", "Ġ")
 
         # Initialize vocab with unique characters
+        text_chars = set(processed_text)
         unique_chars = [chr(i) for i in range(256)]
-        unique_chars.extend(char for char in sorted(set(processed_text)) if char not in unique_chars)
-        if "Ġ" not in unique_chars:
+        unique_chars.extend(sorted(text_chars.difference(unique_chars)))
+        # "Ġ" is outside the first 256 characters, so it is only present if the text has it
+        if "Ġ" not in text_chars:
             unique_chars.append("Ġ")
         
         self.vocab = {i : char for i, char in enumerate(unique_chars)}
@@ -49,22 +70,22 @@ class BPETokenizer:
                     self.vocab[new_id] = token
                     self.inverse_vocab[token] = new_id
 
-        # Tokenize the text
-        token_ids = [self.inverse_vocab[char] for char in processed_text]
+        # Tokenize the text into a compact int32 buffer, which learn_merges merges in
+        # place, releasing the processed copy of the text before the merges start
+        token_ids = array("i", map(self.inverse_vocab.__getitem__, processed_text))
+        del processed_text, text_chars
 
         # Find and Replace frequent pairs
-        for new_id in range(len(self.vocab), vocab_size):
-            pair_id = self.find_freq_pair(token_ids, mode="most")
-            if pair_id is None:
-                break
-            token_ids = self.replace_pair(token_ids, pair_id, new_id)
-            self.bpe_merges[pair_id] = new_id
+        self.bpe_merges.update(self.learn_merges(token_ids, len(self.vocab), vocab_size))
         
         # Build the vocabulary with the merged tokens
+        vocab, inverse_vocab = self.vocab, self.inverse_vocab
         for (p0, p1), new_id in self.bpe_merges.items():
-            merged_token = self.vocab[p0] + self.vocab[p1]
-            self.vocab[new_id] = merged_token
-            self.inverse_vocab[merged_token] = new_id
+            merged_token = vocab[p0] + vocab[p1]
+            vocab[new_id] = merged_token
+            inverse_vocab[merged_token] = new_id
+
+        self.rebuild_lookup_tables()
 
 
     def encode(self, text: str, allowed_special: set[str] | None = None) -> list[int]:
@@ -79,58 +100,91 @@ class BPETokenizer:
             List of token IDs.
         """
 
+        if not allowed_special:
+            return self.encode_ordinary(text)
+
+        # Regex to match allowed special tokens, compiled once per set of tokens
+        special_re = self._special_tokens_re(frozenset(allowed_special))
+        self._ensure_lookup_tables()
+
         token_ids = []
-        if allowed_special is not None and len(allowed_special) > 0:
-            # Build regex to match allowed special tokens
-            special_pattern = ("(" + "|".join(re.escape(tok) for tok in sorted(allowed_special, key=len, reverse=True)) + ")")
-
-            last_index = 0
-            for match in re.finditer(special_pattern, text):
-                prefix = text[last_index:match.start()]
-                # Encode prefix without special handling
-                token_ids.extend(self.encode(prefix, allowed_special=None))
-
-                special_token = match.group(0)
-                if special_token in self.inverse_vocab:
-                    token_ids.append(self.inverse_vocab[special_token])
-                else:
-                    raise ValueError(f"Special token {special_token} not found in vocabulary.")
-                last_index = match.end()
-            
-            # Remaining part to process normally
-            text = text[last_index:]
+        last_index = 0
+        for match in special_re.finditer(text):
+            prefix = text[last_index:match.start()]
+            # Encode prefix without special handling
+            token_ids.extend(self.encode_ordinary(prefix))
+
+            special_token = match.group(0)
+            if special_token in self.inverse_vocab:
+                token_ids.append(self.inverse_vocab[special_token])
+            else:
+                raise ValueError(f"Special token {special_token} not found in vocabulary.")
+            last_index = match.end()
+        
+        # Remaining part to process normally
+        text = text[last_index:]
+
+        # Check if any disallowed special tokens are in the remainder
+        disallowed = [tok for tok in self._special_tokens if tok in text and tok not in allowed_special]
+
+        if disallowed:
+            raise ValueError(f"Disallowed special tokens encounterd in text : {disallowed}")
+
+        token_ids.extend(self.encode_ordinary(text))
+
+        return token_ids
+
 
-            # Check if any disallowed special tokens are in the remainder
-            disallowed = [
-                tok for tok in self.inverse_vocab 
-                if tok.startswith("<|") and tok.endswith("|>") and tok in text and tok not in allowed_special
-            ]
+    def encode_ordinary(self, text: str) -> list[int]:
+        """
+        Encode the input text into a list of token IDs, treating special tokens as ordinary text
 
-            if disallowed:
-                raise ValueError(f"Disallowed special tokens encounterd in text : {disallowed}")
+        Args:
+            text (str) : The input text to encode
 
-        # If no special tokens or remaining text after special token split
+        Returns:
+            List of token IDs.
+        """
+
+        # Split into lines and words, prefixing every word but the first with "Ġ"
         tokens = []
-        lines = text.split("\n")
-        for i, line in enumerate(lines):
+        for i, line in enumerate(text.split("\n")):
+            words = line.split()
             if i > 0:
                 tokens.append("\n")
-            words = line.split()
-            for j, word in enumerate(words):
-                if j == 0 and i > 0:
-                    tokens.append("Ġ" + word)
-                elif j == 0:
-                    tokens.append(word)
-                else:
-                    tokens.append("Ġ" + word)
+            elif words:
+                tokens.append(words[0])
+                del words[0]
+            tokens.extend(["Ġ" + word for word in words])
 
+        # Single lookup per token, with the hot attributes bound locally
+        self._ensure_lookup_tables()
+        token_ids = []
+        inverse_vocab_get = self.inverse_vocab.get
+        append, extend = token_ids.append, token_ids.extend
         for token in tokens:
-            if token in self.inverse_vocab:
-                token_ids.append(self.inverse_vocab[token])
+            token_id = inverse_vocab_get(token)
+            if token_id is not None:
+                append(token_id)
             else:
-                token_ids.extend(self.tokenize_with_bpe(token))
+                extend(self._tokenize_with_bpe(token))
 
         return token_ids
+
+
+    def encode_batch(self, texts: list[str], allowed_special: set[str] | None = None) -> list[list[int]]:
+        """
+        Encode a batch of texts into lists of token IDs
+
+        Args:
+            texts (list[str]) : The input texts to encode
+            allowed_special (set or None) : Special tokens to allow passthrough
+
+        Returns:
+            List of token ID lists, one per input text.
+        """
+
+        return [self.encode(text, allowed_special=allowed_special) for text in texts]
             
 
     def tokenize_with_bpe(self, token: str) -> list[int]:
@@ -144,77 +198,105 @@ class BPETokenizer:
             list[int] : The list of token IDs after applying BPE 
         """
 
+        self._ensure_lookup_tables()
+        return self._tokenize_with_bpe(token)
+
+
+    def _tokenize_with_bpe(self, token: str) -> list[int]:
+        """
+        Tokenize a single token using BPE merges, assuming the lookup tables are current
+        """
+
         # Tokenize the token into individual characters
-        token_ids = [self.inverse_vocab.get(char, None) for char in token]
+        inverse_vocab_get = self.inverse_vocab.get
+        token_ids = [inverse_vocab_get(char) for char in token]
         if None in token_ids:
             missing_chars = [char for char, tid in zip(token, token_ids) if tid is None]
             raise ValueError(f"Characters not found in vocab : {missing_chars}")
         
+        merges_get = self._merge_table.get
+        no_merges = {}
         can_merge = True
         while can_merge and len(token_ids) > 1:
             can_merge = False
             new_tokens = []
+            append = new_tokens.append
+            n = len(token_ids)
             i = 0
-            while i < len(token_ids) - 1:
-                pair = (token_ids[i], token_ids[i+1])
-                if pair in self.bpe_merges:
-                    merged_token_id = self.bpe_merges[pair]
-                    new_tokens.append(merged_token_id)
+            while i < n - 1:
+                merged_token_id = merges_get(token_ids[i], no_merges).get(token_ids[i+1])
+                if merged_token_id is not None:
+                    append(merged_token_id)
                     i += 2
                     can_merge = True
                 else:
-                    new_tokens.append(token_ids[i])
+                    append(token_ids[i])
                     i += 1
-            if i < len(token_ids):
-                new_tokens.append(token_ids[i])
+            if i < n:
+                append(token_ids[i])
             token_ids = new_tokens
 
         return token_ids
     
 
-    def decode(self, token_ids: list[int]) -> str:
+    def decode(self, token_ids: Iterable[int]) -> str:
         """
-        Decode a list of token IDs back into a string
+        Decode token IDs back into a string
 
         Args:
-            token_ids (list[int]) : The list of token IDs to decode
+            token_ids (Iterable[int]) : The token IDs to decode
 
         Returns:
             str: The decoded string
         """
 
-        decoded_string = ""
-        for i, token_id in enumerate(token_ids):
-            if token_id not in self.vocab:
+        return self.decode_bytes(token_ids).decode("utf-8", errors="surrogatepass")
+
+
+    def decode_bytes(self, token_ids: Iterable[int]) -> bytes:
+        """
+        Decode token IDs into UTF-8 encoded bytes
+
+        Args:
+            token_ids (Iterable[int]) : The token IDs to decode
+
+        Returns:
+            bytes: The decoded string encoded as UTF-8
+        """
+
+        self._ensure_lookup_tables()
+        parts = []
+        append = parts.append
+        decoded_bytes_get = self._decoded_bytes.get
+        for token_id in token_ids:
+            decoded_bytes = decoded_bytes_get(token_id)
+            if decoded_bytes is None:
                 raise ValueError(f"Token ID {token_id} not found in vocab")
-            token = self.vocab[token_id]
-            if token == "\n":
-                if decoded_string and not decoded_string.endswith(" "):
-                    decoded_string += " "
-                decoded_string += token
-            elif token.startswith("Ġ"):
-                decoded_string += " " + token[1:]
-            else:
-                decoded_string += token
+            # A newline is separated from the preceding text by a space
+            if decoded_bytes == b"\n" and parts and not parts[-1].endswith(b" "):
+                append(b" ")
+            append(decoded_bytes)
 
-        return decoded_string
+        return b"".join(parts)
     
 
-    def save_vocab_and_merges(self, vocab_path: str, bpe_merges_path: str) -> None:
+    def save_vocab_and_merges(self, vocab_path: str, bpe_merges_path: str, indent: int | None = None) -> None:
         """
         Saves the vocabulary and BPE merges to JSON files
 
         Args:
             vocab_path (str) : Path to save vocabulary
             bpe_merges_path (str) : Path to save the BPE merges
+            indent (int or None) : Indentation for readable output, compact when None
         """
 
+        # json.dumps in one call uses the C encoder unless an indent is requested
         with open(vocab_path, "w", encoding="utf-8") as file:
-            json.dump(self.vocab, file, ensure_ascii=False, indent=4)
+            file.write(json.dumps(self.vocab, ensure_ascii=False, indent=indent))
 
         with open(bpe_merges_path, "w", encoding="utf-8") as file:
             merges_list = [{"pair" : list(pair), "new_id" : new_id} for pair, new_id in self.bpe_merges.items()]
-            json.dump(merges_list, file, ensure_ascii=False, indent=4)
+            file.write(json.dumps(merges_list, ensure_ascii=False, indent=indent))
 
     
     def load_vocab_and_merges(self, vocab_path: str, bpe_merges_path: str) -> None:
@@ -229,41 +311,347 @@ class BPETokenizer:
         with open(vocab_path, "r", encoding="utf-8") as file:
             loaded_vocab = json.load(file)
             self.vocab = {int(k) : v for k, v in loaded_vocab.items()}
-            self.inverse_vocab = {v : int(k) for k, v in loaded_vocab.items()}
+            self.inverse_vocab = {v : k for k, v in self.vocab.items()}
 
         with open(bpe_merges_path, "r", encoding="utf-8") as file:
             merges_list = json.load(file)
-            for merge in merges_list:
-                pair = tuple(merge["pair"])
-                new_id = merge["new_id"]
-                self.bpe_merges[pair] = new_id
+            self.bpe_merges = {tuple(merge["pair"]) : merge["new_id"] for merge in merges_list}
+
+        self.rebuild_lookup_tables()
+
+
+    def save_vocab_and_merges_bin(self, path: str) -> None:
+        """
+        Saves the vocabulary and BPE merges to a single binary file
+
+        The file holds a header, the token IDs, the token lengths and the merges as
+        little-endian int32 arrays, followed by all tokens concatenated as UTF-8
+
+        Args:
+            path (str) : Path to save the vocabulary and BPE merges
+        """
+
+        token_ids = array("i", self.vocab.keys())
+        tokens = list(self.vocab.values())
+        token_lengths = array("i", map(len, tokens))
+        merges = array("i")
+        for (p0, p1), new_id in self.bpe_merges.items():
+            merges.extend((p0, p1, new_id))
+        if sys.byteorder == "big":
+            for buffer in (token_ids, token_lengths, merges):
+                buffer.byteswap()
+
+        with open(path, "wb") as file:
+            file.write(_BINARY_HEADER.pack(_BINARY_MAGIC, _BINARY_VERSION, len(token_ids), len(self.bpe_merges)))
+            token_ids.tofile(file)
+            token_lengths.tofile(file)
+            merges.tofile(file)
+            file.write("".join(tokens).encode("utf-8", errors="surrogatepass"))
+
+
+    def load_vocab_and_merges_bin(self, path: str) -> None:
+        """
+        Load the vocabulary and BPE merges from a binary file written by `save_vocab_and_merges_bin`
+
+        Args:
+            path (str) : Path to the binary vocabulary and BPE merges file
+        """
+
+        with open(path, "rb") as file:
+            data = file.read()
+
+        if len(data) < _BINARY_HEADER.size:
+            raise ValueError(f"{path} is not a BPE vocabulary file")
+        magic, version, vocab_size, num_merges = _BINARY_HEADER.unpack_from(data)
+        if magic != _BINARY_MAGIC or version != _BINARY_VERSION:
+            raise ValueError(f"{path} is not a version {_BINARY_VERSION} BPE vocabulary file")
+
+        buffers = []
+        offset = _BINARY_HEADER.size
+        for length in (vocab_size, vocab_size, 3 * num_merges):
+            buffer = array("i")
+            if offset + length * buffer.itemsize > len(data):
+                raise ValueError(f"{path} is truncated")
+            buffer.frombytes(data[offset:offset + length * buffer.itemsize])
+            if sys.byteorder == "big":
+                buffer.byteswap()
+            buffers.append(buffer)
+            offset += length * buffer.itemsize
+        token_ids, token_lengths, merges = buffers
+
+        # Decode all tokens at once, then slice them apart by their lengths
+        try:
+            text = data[offset:].decode("utf-8", errors="surrogatepass")
+        except UnicodeDecodeError as error:
+            raise ValueError(f"{path} has invalid token data : {error}") from None
+        ends = list(accumulate(token_lengths))
+        starts = [0] + ends[:-1]
+        if any(length < 0 for length in token_lengths) or (ends[-1] if ends else 0) != len(text):
+            raise ValueError(f"{path} is truncated or has invalid token lengths")
+
+        self.vocab = {token_id : text[start:end] for token_id, start, end in zip(token_ids, starts, ends)}
+        self.inverse_vocab = {v : k for k, v in self.vocab.items()}
+        self.bpe_merges = {(p0, p1) : new_id for p0, p1, new_id in zip(merges[0::3], merges[1::3], merges[2::3])}
+
+        self.rebuild_lookup_tables()
     
 
+    def rebuild_lookup_tables(self) -> None:
+        """
+        Precompute the lookup tables derived from the vocabulary and BPE merges
+
+        Reassigning `vocab`, `inverse_vocab` or `bpe_merges`, or adding and removing
+        entries, is picked up automatically. Call this after editing existing entries
+        in place.
+        """
+
+        self._special_tokens = [tok for tok in self.inverse_vocab if tok.startswith("<|") and tok.endswith("|>")]
+        self._decoded_bytes = {
+            token_id : (" " + token[1:] if token.startswith("Ġ") else token).encode("utf-8", errors="surrogatepass")
+            for token_id, token in self.vocab.items()
+        }
+        # Two lookups on small int keys are cheaper than building and hashing a tuple key
+        self._merge_table = {}
+        for (p0, p1), new_id in self.bpe_merges.items():
+            self._merge_table.setdefault(p0, {})[p1] = new_id
+        self._lookup_tables_source = (self.vocab, self.inverse_vocab, self.bpe_merges)
+        self._lookup_tables_sizes = (len(self.vocab), len(self.inverse_vocab), len(self.bpe_merges))
+
+
+    def _ensure_lookup_tables(self) -> None:
+        """
+        Rebuild the lookup tables if the vocab or merges were reassigned or resized
+        """
+
+        vocab, inverse_vocab, bpe_merges = self._lookup_tables_source
+        if (
+            vocab is not self.vocab or inverse_vocab is not self.inverse_vocab or bpe_merges is not self.bpe_merges
+            or self._lookup_tables_sizes != (len(self.vocab), len(self.inverse_vocab), len(self.bpe_merges))
+        ):
+            self.rebuild_lookup_tables()
+
+
+    @staticmethod
+    def special_tokens_pattern(tokens: Iterable[str]) -> str:
+        """
+        Build a regex matching any of the given tokens, preferring the longest match
+
+        The tokens are arranged in a trie, so shared prefixes like "<|" are matched once
+        instead of being retried for every alternative at each position of the text.
+        Falls back to a flat alternation when the trie nests too deeply for `re`.
+
+        Args:
+            tokens (Iterable[str]) : The tokens to match
+
+        Returns:
+            str : The regex pattern, without a capturing group
+        """
+
+        tokens = list(tokens)
+        trie = {}
+        for token in tokens:
+            node = trie
+            for char in token:
+                node = node.setdefault(char, {})
+            # The empty key marks the end of a token
+            node[""] = {}
+
+        def follow(char, child):
+            # Collapse a run of single-child nodes into one literal
+            run = [char]
+            while len(child) == 1 and "" not in child:
+                (char, child), = child.items()
+                run.append(char)
+            return re.escape("".join(run)), child
+
+        # Visit the nodes where tokens branch or end in preorder, without recursion
+        order = []
+        edges = {}
+        stack = [(trie, 0)]
+        while stack:
+            node, depth = stack.pop()
+            if depth > _MAX_PATTERN_NESTING:
+                return "|".join(re.escape(tok) for tok in sorted(tokens, key=len, reverse=True))
+            order.append(node)
+            edges[id(node)] = [follow(char, child) for char, child in sorted(node.items()) if char]
+            stack.extend((child, depth + 1) for _, child in edges[id(node)])
+
+        # Build the patterns bottom-up, children come after their parent in preorder
+        patterns = {}
+        for node in reversed(order):
+            branches = [literal + patterns[id(child)] for literal, child in edges[id(node)]]
+            if not branches:
+                patterns[id(node)] = ""
+                continue
+            if "" in node:
+                # Try the longer tokens first, then accept the token ending here
+                branches.append("")
+            elif len(branches) == 1:
+                patterns[id(node)] = branches[0]
+                continue
+            patterns[id(node)] = "(?:" + "|".join(branches) + ")"
+
+        return patterns[id(trie)]
+
+
+    @staticmethod
+    @lru_cache(maxsize=64)
+    def _special_tokens_re(allowed_special: frozenset[str]) -> re.Pattern:
+        """
+        Compile a regex capturing any of the allowed special tokens, keeping the recently used ones
+        """
+
+        return re.compile("(" + BPETokenizer.special_tokens_pattern(allowed_special) + ")")
+
+
+    @staticmethod
+    def learn_merges(token_ids: Sequence[int], first_id: int, vocab_size: int) -> dict[tuple[int, int], int]:
+        """
+        Repeatedly merge the most frequent pair using an incremental pair-frequency index
+
+        The token IDs are kept as a doubly-linked list, so a merge only touches the
+        occurrences of the merged pair and their neighbours instead of recounting
+        every pair. Produces the same merges as calling `find_freq_pair` and
+        `replace_pair` in a loop, including tie-breaking on the first occurrence.
+
+        Args:
+            token_ids (Sequence[int]) : The token IDs of the training text, merged in place
+                                        when an array("i") and copied otherwise
+            first_id (int) : The token ID of the first merged token
+            vocab_size (int) : The vocabulary size
+
+        Returns:
+            dict[tuple[int, int], int] : The BPE merges in the order they were made
+        """
+
+        n = len(token_ids)
+        # Reuse an int32 buffer instead of holding a second copy of the text's token IDs
+        if isinstance(token_ids, array) and token_ids.typecode == "i":
+            tokens = token_ids
+        else:
+            tokens = array("i", token_ids)
+        prev_idx = array("i", range(-1, n - 1))
+        next_idx = array("i", range(1, n + 1))
+        if n:
+            next_idx[-1] = -1
+        removed = bytearray(n)
+
+        # pair -> number of occurrences, and pair -> left position of each occurrence
+        pair_counts = defaultdict(int)
+        pair_positions = defaultdict(set)
+        # pair -> lower bound of its first position, used to break ties like `find_freq_pair`
+        first_pos = {}
+        # Pairs whose count changed during the current merge
+        touched = set()
+
+        def add_pair(pair, pos):
+            pair_counts[pair] += 1
+            pair_positions[pair].add(pos)
+            if pos < first_pos.get(pair, n):
+                first_pos[pair] = pos
+            touched.add(pair)
+
+        def remove_pair(pair, pos):
+            pair_counts[pair] -= 1
+            pair_positions[pair].discard(pos)
+            touched.add(pair)
+
+        for i, pair in enumerate(zip(tokens, tokens[1:])):
+            pair_counts[pair] += 1
+            pair_positions[pair].add(i)
+            first_pos.setdefault(pair, i)
+        # Lazy max-heap of (-count, first position, pair), stale entries are skipped
+        heap = [(-count, first_pos[pair], pair) for pair, count in pair_counts.items()]
+        heapq.heapify(heap)
+
+        merges = {}
+        for new_id in range(first_id, vocab_size):
+            pair_id = None
+            while heap:
+                neg_count, pos, pair = heapq.heappop(heap)
+                if neg_count == 0 or pair_counts.get(pair) != -neg_count:
+                    continue
+                first = min(pair_positions[pair])
+                if pos != first:
+                    first_pos[pair] = first
+                    heapq.heappush(heap, (neg_count, first, pair))
+                    continue
+                pair_id = pair
+                break
+            if pair_id is None:
+                break
+
+            a, b = pair_id
+            for i in sorted(pair_positions[pair_id]):
+                # Earlier merges in this pass may have consumed this occurrence
+                j = next_idx[i]
+                if removed[i] or j == -1 or tokens[i] != a or tokens[j] != b:
+                    continue
+                left, right = prev_idx[i], next_idx[j]
+
+                if left != -1:
+                    remove_pair((tokens[left], a), left)
+                remove_pair(pair_id, i)
+                if right != -1:
+                    remove_pair((b, tokens[right]), j)
+
+                # Merge the pair into node i and unlink node j
+                tokens[i] = new_id
+                removed[j] = 1
+                next_idx[i] = right
+                if right != -1:
+                    prev_idx[right] = i
+
+                if left != -1:
+                    add_pair((tokens[left], new_id), left)
+                if right != -1:
+                    add_pair((new_id, tokens[right]), i)
+
+            # Push each changed pair once per merge rather than once per occurrence
+            touched.discard(pair_id)
+            for pair in touched:
+                if pair_counts[pair]:
+                    heapq.heappush(heap, (-pair_counts[pair], first_pos[pair], pair))
+            touched.clear()
+
+            del pair_counts[pair_id], pair_positions[pair_id]
+            merges[pair_id] = new_id
+
+        return merges
+
+
     @staticmethod
-    def find_freq_pair(token_ids: list[int], mode: str = "most") -> tuple[int, int] | None:
-        pairs = Counter(zip(token_ids, token_ids[1:]))
+    def find_freq_pair(token_ids: Sequence[int], mode: str = "most") -> tuple[int, int] | None:
+        # islice avoids copying the whole sequence just to offset it by one
+        pairs = Counter(zip(token_ids, islice(token_ids, 1, None)))
 
         if not pairs:
             return None
         
         if mode == "most":
-            return max(pairs.items(), key=lambda x: x[1])[0]
+            # Like max(), most_common(1) returns the first pair among equal counts
+            return pairs.most_common(1)[0][0]
         elif mode == "least":
-            return min(pairs.items(), key=lambda x: x[1])[0]
+            return min(pairs.items(), key=itemgetter(1))[0]
         else:
             raise ValueError("Invalid mode. Choose 'most' or 'least'")
         
     @staticmethod
-    def replace_pair(token_ids: list[int], pair_id: tuple[int, int], new_id: int) -> list[int]:
-        dq = deque(token_ids)
+    def replace_pair(token_ids: Sequence[int], pair_id: tuple[int, int], new_id: int) -> list[int]:
+        a, b = pair_id
+        n = len(token_ids)
         replaced = []
+        append = replaced.append
 
-        while dq:
-            current = dq.popleft()
-            if dq and (current, dq[0]) == pair_id:
-                replaced.append(new_id)
-                dq.popleft()
+        i = 0
+        while i < n - 1:
+            if token_ids[i] == a and token_ids[i + 1] == b:
+                append(new_id)
+                i += 2
             else:
-                replaced.append(current)
+                append(token_ids[i])
+                i += 1
+        if i < n:
+            append(token_ids[i])
 
         return replaced
\ No newline at end of file
@@ -1,12 +1,16 @@
+from pathlib import Path
 from setuptools import setup, find_packages
 
+readme_path = Path(__file__).with_name("README.md")
+long_description = readme_path.read_text(encoding="utf-8") if readme_path.exists() else ""
+
 setup(
     name="Lucid",
     version="0.1.0",
     description="Library to simplify Training",
     author="Kushal Gajjar",
     author_email="kushalgajjar1@gmail.com",
-    long_description=open('README.md').read(),
+    long_description=long_description,
     long_description_content_type='text/markdown',
     packages=find_packages(),
     install_requires=[],